@@ -1,21 +1,76 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple, Callable
 import os
 import time
+import re
+import copy
 import json
+import random
+import asyncio
+import logging
+import threading
+import hashlib
+import importlib.util
+import tempfile
+import functools
 import pdfplumber
-import librosa
-import pandas as pd
+import numpy as np
+import soundfile as sf
+from pydub import AudioSegment
 from pathlib import Path
-from openai import OpenAIError, RateLimitError, APIConnectionError, Timeout
+from pydantic import BaseModel, ConfigDict, ValidationError
+from openai import OpenAIError, RateLimitError, APIConnectionError, InternalServerError
 from dotenv import load_dotenv
 import openai
+import httpx
+import tiktoken
 
 # Load environment variables from .env (if present)
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+logger = logging.getLogger(__name__)
+
+# One client for the whole process so every call reuses pooled HTTP/2 connections
+@functools.lru_cache(maxsize=None)
+def _get_client() -> openai.OpenAI:
+    """Build the shared client on first use, so importing doesn't require OPENAI_API_KEY."""
+    return openai.OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+        )
+    )
+
 
 MAX_RETRIES = 3
 INITIAL_BACKOFF = 2.0
+RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+TPM_LIMIT = os.getenv("OPENAI_TPM_LIMIT")  # if set, overrides MODEL_TPM_LIMITS for every model
+MODEL_TPM_LIMITS = {"gpt-4-0613": 10000, "gpt-4o-2024-08-06": 30000, "gpt-4o-mini": 200000}  # usage tier 1
+DEFAULT_TPM_LIMIT = 30000
+MAX_INFLIGHT = 8
+AIMD_INCREASE_EVERY = 20  # successes before allowing one more in-flight request
+DEFAULT_COMPLETION_TOKENS = 1024  # assumed completion size when max_tokens is not set
+CHARS_PER_TOKEN = 4  # rough English average, used when tiktoken's encoding cannot be loaded
+FALLBACK_MODEL = os.getenv("OPENAI_FALLBACK_MODEL", "gpt-4o-mini")
+BREAKER_FAIL_MAX = 5  # consecutive transient failures before routing to FALLBACK_MODEL
+BREAKER_RESET_TIMEOUT = 30.0  # seconds before probing the primary model again
+PER_STUDENT_MAX_TOKENS = 1024  # completion budget per student in batched grading
+GRADING_MODEL = "gpt-4o-2024-08-06"  # structured outputs need gpt-4o-2024-08-06 or later
+PROMPT_VERSION = "1"  # bump when prompts or result schemas change, so cached gradings are not reused
+GRADING_MAX_TOKENS = 2048  # completion budget reserved for single-student grading
+MODEL_CONTEXT_TOKENS = {"gpt-4-0613": 8192, "gpt-4o-2024-08-06": 128000, "gpt-4o-mini": 128000}
+MODEL_MAX_OUTPUT_TOKENS = {"gpt-4-0613": 8192, "gpt-4o-2024-08-06": 16384, "gpt-4o-mini": 16384}
+SILENCE_TOP_DB = 30  # frames this far below the loudest frame count as silence
+SILENCE_FRAME_SECONDS = 0.032  # hop between frames: 512 samples at 16 kHz, librosa's default
+SILENCE_FRAME_HOPS = 4  # each frame spans 4 hops (2048 samples at 16 kHz), as in librosa.effects.split
+MIN_VOICED_SECONDS = 0.5  # below this much speech the pitch is treated as silent
+MIN_TRIM_FRACTION = 0.05  # trim leading/trailing silence only when it saves this share of the audio
+WHISPER_MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+UPLOAD_COMPRESSION_LEVEL = 1.0  # smallest Ogg Vorbis (~48 kbit/s mono), ample for speech recognition
+TRANSCRIBE_BACKEND = os.getenv("TRANSCRIBE_BACKEND", "api")  # "api" (whisper-1) or "local" (faster-whisper)
+LOCAL_WHISPER_MODEL = os.getenv("LOCAL_WHISPER_MODEL", "small")
+if TRANSCRIBE_BACKEND == "local" and importlib.util.find_spec("faster_whisper") is None:
+    raise ImportError("TRANSCRIBE_BACKEND=local needs faster-whisper: pip install faster-whisper")
 RUBRIC_CACHE_DIR = os.path.join(os.getcwd(), "cache")
 os.makedirs(RUBRIC_CACHE_DIR, exist_ok=True)
 
@@ -76,19 +131,7 @@ You are a grading assistant for technical exams. Your role is to evaluate studen
   - Offer suggestions for improvement if the answer is incomplete or incorrect.
 
 ### Output Format:
-Respond ONLY with raw JSON (no markdown):
-{
-  "question_1": {
-    "score": X,
-    "feedback": "..."
-  },
-  "question_2": {
-    "score": Y,
-    "feedback": "..."
-  },
-  ...
-  "total_score": Z
-}
+Respond in JSON with one entry in "scores" per question (its number as "question_id", plus "score" and "feedback"), then the "total_score".
 
 ### Rubric (if available):
 {rubric_markdown}
@@ -96,104 +139,263 @@ Respond ONLY with raw JSON (no markdown):
 
 # Narrative agent prompt
 NARRATIVE_PROMPT_WITH_RUBRIC = """
-You are an exam grader. Use the rubric to assign each question a numeric score (0-10) and valuable concise feedback so the student can further understand their strengths and weaknesses of the material. Then compute the overall score as the average and provide general feedback. Return JSON.
+You are an exam grader. Use the rubric to assign each question a numeric score (0-10) and valuable concise feedback so the student can further understand their strengths and weaknesses of the material. Then compute the overall score as the average and provide general feedback.
 
 ### Output Format:
-Respond ONLY with raw JSON (no markdown):
-{
-  "question_1": {
-    "score": X,
-    "feedback": "..."
-  },
-  "question_2": {
-    "score": Y,
-    "feedback": "..."
-  },
-  ...
-  "total_score": Z
-}
+Respond in JSON with one entry in "scores" per question (its number as "question_id", plus "score" and "feedback"), then the "total_score" and the "general_feedback".
 """
 
 NARRATIVE_PROMPT_NO_RUBRIC = """
-You are an exam grader. The rubric is not available. Use your own criteria to assign each question a numeric score (0-10) and constructive feedback. Then compute the overall score as the average and provide general feedback. Return JSON.
+You are an exam grader. The rubric is not available. Use your own criteria to assign each question a numeric score (0-10) and constructive feedback. Then compute the overall score as the average and provide general feedback.
 
 ### Output Format:
-Respond ONLY with raw JSON (no markdown):
-{
-  "question_1": {
-    "score": X,
-    "feedback": "..."
-  },
-  "question_2": {
-    "score": Y,
-    "feedback": "..."
-  },
-  ...
-  "total_score": Z
-}
+Respond in JSON with one entry in "scores" per question (its number as "question_id", plus "score" and "feedback"), then the "total_score" and the "general_feedback".
 """
 
+# Appended to the system prompt when several students are graded in one request
+BATCH_PROMPT_SUFFIX = """
+
+### Batch Grading:
+The student responses below contain several students, each introduced by a "## Student <id>" header.
+Grade each student independently and respond with one entry in "students" per student: their id as "student_id"
+and their grading, in the format described above, as "grading".
+"""
+
+
+# ========== RESULT SCHEMAS ==========
+class QuestionGrade(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    question_id: int
+    score: float
+    feedback: str
+
+
+class TechnicalResult(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    scores: List[QuestionGrade]
+    total_score: float
+
+
+class NarrativeResult(TechnicalResult):
+    general_feedback: str
+
+
+class TechnicalStudentResult(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    student_id: str
+    grading: TechnicalResult
+
+
+class NarrativeStudentResult(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    student_id: str
+    grading: NarrativeResult
+
+
+class TechnicalBatchResult(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    students: List[TechnicalStudentResult]
+
+
+class NarrativeBatchResult(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    students: List[NarrativeStudentResult]
+
+
+# Result model per (exam type, batch); the JSON schema sent as response_format is built once per model
+_RESULT_MODELS = {
+    ("technical", False): TechnicalResult,
+    ("narrative", False): NarrativeResult,
+    ("technical", True): TechnicalBatchResult,
+    ("narrative", True): NarrativeBatchResult,
+}
+_RESPONSE_FORMATS = {
+    key: {
+        "type": "json_schema",
+        "json_schema": {"name": "grading", "schema": model.model_json_schema(), "strict": True}
+    }
+    for key, model in _RESULT_MODELS.items()
+}
+
+# Per-line cleanup for extracted PDF text: trim each line, then turn any bullet glyph into "- "
+_EDGE_SPACE_RE = re.compile(r"^[^\S\n]+|[^\S\n]+$", re.M)
+_BULLET_RE = re.compile(r"^[*•·-]+[^\S\n]*", re.M)
+
 # ========== UTILITIES ==========
+def file_sha256(path: str) -> str:
+    """Return the SHA-256 hex digest of a file's contents, hashed in chunks."""
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_cache_file(cache_file: str, text: str):
+    """Write `text` via a unique temp file and os.replace, so readers never see a partial file."""
+    fd, tmp_file = tempfile.mkstemp(dir=RUBRIC_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_file, cache_file)
+
+
+def cache_markdown_by_content(fn):
+    """Cache PDF->markdown results on disk by content hash and in memory by (path, mtime, size)."""
+    @functools.lru_cache(maxsize=64)
+    def cached(pdf_path: str, mtime_ns: int, size: int) -> str:
+        cache_file = os.path.join(RUBRIC_CACHE_DIR, file_sha256(pdf_path) + ".md")
+        if os.path.exists(cache_file):
+            with open(cache_file, "r", encoding="utf-8") as f:
+                return f.read()
+
+        markdown = fn(pdf_path)
+        # A unique temp file per writer, so concurrent misses on the same PDF never collide
+        _write_cache_file(cache_file, markdown)
+        return markdown
+
+    @functools.wraps(fn)
+    def wrapper(pdf_path: str) -> str:
+        st = os.stat(pdf_path)
+        return cached(os.path.abspath(pdf_path), st.st_mtime_ns, st.st_size)
+
+    return wrapper
+
+
+@cache_markdown_by_content
 def extract_pdf_to_markdown(pdf_path: str) -> str:
     def clean_text_formatting(text: str) -> str:
-        lines = text.split("\n")
-        cleaned = []
-        for line in lines:
-            s = line.strip()
-            if not s:
-                cleaned.append("")
-            elif s[0] in ("*", "•", "·", "-"):
-                cleaned.append("- " + s.lstrip("*•·-").strip())
-            else:
-                cleaned.append(s)
-        return "\n".join(cleaned) + "\n"
+        return _BULLET_RE.sub("- ", _EDGE_SPACE_RE.sub("", text)) + "\n"
 
     def convert_table_to_markdown(table: List[List[str]]) -> str:
         header, *rows = table
-        md = "| " + " | ".join(header) + " |\n"
-        md += "| " + " | ".join("--" for _ in header) + " |\n"
-        for r in rows:
-            md += "| " + " | ".join(cell or "" for cell in r) + " |\n"
-        return md
+        header_line = "| " + " | ".join(cell or "" for cell in header) + " |"
+        sep_line = "| " + " | ".join("--" for _ in header) + " |"
+        rows_md = ["| " + " | ".join(cell or "" for cell in r) + " |" for r in rows]
+        return "\n".join([header_line, sep_line, *rows_md]) + "\n"
 
-    out = ""
+    parts = []
     with pdfplumber.open(pdf_path) as pdf:
         for i, page in enumerate(pdf.pages, start=1):
-            out += f"\n\n## Page {i}\n"
+            parts.append(f"\n\n## Page {i}\n")
             text = page.extract_text() or ""
-            out += clean_text_formatting(text)
+            parts.append(clean_text_formatting(text))
             for tbl in page.extract_tables() or []:
-                out += "\n" + convert_table_to_markdown(tbl)
-    return out
+                parts.append("\n" + convert_table_to_markdown(tbl))
+    return "".join(parts)
+
+
+@functools.lru_cache(maxsize=None)
+def _local_whisper_model():
+    """Load the faster-whisper model once: int8 on GPU when CUDA is available, otherwise on CPU."""
+    import ctranslate2
+    from faster_whisper import WhisperModel
+
+    if ctranslate2.get_cuda_device_count() > 0:
+        return WhisperModel(LOCAL_WHISPER_MODEL, device="cuda", compute_type="int8_float16")
+    return WhisperModel(LOCAL_WHISPER_MODEL, device="cpu", compute_type="int8")
 
 
-def transcribe(mp3_path: str) -> str:
-    """Return transcript from Whisper with simple caching logic."""
-    cache_file = os.path.join(RUBRIC_CACHE_DIR, os.path.basename(mp3_path) + ".txt")
+def transcribe(mp3_path: str, samples: np.ndarray = None, sr: int = 0) -> str:
+    """
+    Return transcript from Whisper, cached by the audio's content hash, backend and model.
+    If `samples` is given (the decoded file, e.g. with silence trimmed), it is uploaded instead as
+    mono Ogg Vorbis, unless that still exceeds Whisper's upload limit.
+    TRANSCRIBE_BACKEND=local runs faster-whisper in-process instead of calling the API.
+    """
+    model = LOCAL_WHISPER_MODEL if TRANSCRIBE_BACKEND == "local" else "whisper-1"
+    key = hashlib.sha256("||".join([TRANSCRIBE_BACKEND, model, file_sha256(mp3_path)]).encode("utf-8")).hexdigest()
+    cache_file = os.path.join(RUBRIC_CACHE_DIR, key + ".txt")
     if os.path.exists(cache_file):
         return open(cache_file, "r").read()
 
-    with open(mp3_path, "rb") as f:
-        resp = openai.audio.transcriptions.create(
-            file=f,
-            model="whisper-1",
-            response_format="text"
-        )
-    transcript = resp if isinstance(resp, str) else resp.get("text", "")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        upload_path = mp3_path
+        if samples is not None:
+            # Native rate: the encoder low-passes, and Whisper resamples to 16 kHz itself
+            ogg_path = os.path.join(tmp_dir, Path(mp3_path).stem + ".ogg")
+            with sf.SoundFile(ogg_path, "w", sr, 1, format="OGG", subtype="VORBIS",
+                              compression_level=UPLOAD_COMPRESSION_LEVEL) as f:
+                # Block writes: libsndfile's Vorbis encoder crashes on one multi-minute write
+                for i in range(0, len(samples), 1 << 16):
+                    f.write(samples[i:i + (1 << 16)])
+            if os.path.getsize(ogg_path) <= WHISPER_MAX_UPLOAD_BYTES:
+                upload_path = ogg_path
+        if TRANSCRIBE_BACKEND == "local":
+            segments, _ = _local_whisper_model().transcribe(upload_path)
+            transcript = " ".join(segment.text.strip() for segment in segments)
+        else:
+            with open(upload_path, "rb") as f:
+                resp = _get_client().audio.transcriptions.create(
+                    file=f,
+                    model=model,
+                    response_format="text"
+                )
+            transcript = resp if isinstance(resp, str) else resp.get("text", "")
     with open(cache_file, "w") as f:
         f.write(transcript)
     return transcript
 
 
-def analyze_audio(mp3_path: str) -> Dict[str, Any]:
-    y, sr = librosa.load(mp3_path, sr=16000, mono=True)
+def load_audio(audio_path: str):
+    """Decode audio to a mono float32 array at its native sample rate."""
+    try:
+        y, sr = sf.read(audio_path, dtype="float32", always_2d=False)
+    except sf.SoundFileError:  # MP3 on older libsndfile, or anything else only ffmpeg understands
+        segment = AudioSegment.from_file(audio_path)
+        y = np.array(segment.get_array_of_samples(), dtype=np.float32)
+        y /= float(1 << (8 * segment.sample_width - 1))
+        y = y.reshape(-1, segment.channels)
+        sr = segment.frame_rate
+    if y.ndim > 1:
+        y = y.mean(axis=1)
+    return y, sr
+
+
+def voiced_frames(y: np.ndarray, sr: int, top_db: float = SILENCE_TOP_DB):
+    """
+    Return (mask, hop): which frames are within top_db of the loudest frame.
+    Frames are centred every hop samples and overlap (SILENCE_FRAME_HOPS hops wide, zero-padded
+    at the edges), matching librosa.effects.split so silence ratios line up with the rubric bands.
+    """
+    hop = max(1, int(sr * SILENCE_FRAME_SECONDS))
+    frame_length = SILENCE_FRAME_HOPS * hop
+    frames = np.lib.stride_tricks.sliding_window_view(np.pad(y, frame_length // 2), frame_length)[::hop]
+    rms = np.sqrt(np.einsum("ij,ij->i", frames, frames) / frame_length)
+    if not len(y) or rms.max() == 0:
+        return np.zeros(len(rms), dtype=bool), hop
+    return rms > rms.max() * 10 ** (-top_db / 20), hop
+
+
+async def analyze_audio(mp3_path: str) -> Dict[str, Any]:
+    # Silence detection works at any rate, so keep the native one instead of resampling
+    y, sr = await asyncio.to_thread(load_audio, mp3_path)
     duration = len(y) / sr
-    transcript = transcribe(mp3_path)
+    mask, hop = await asyncio.to_thread(voiced_frames, y, sr)
+    voiced_samples = min(int(mask.sum()) * hop, len(y))
+    silence_ratio = float(1 - voiced_samples / len(y)) if len(y) else 0
+
+    if voiced_samples / sr < MIN_VOICED_SECONDS:
+        transcript = ""  # effectively silent: nothing for Whisper to transcribe
+    else:
+        # Only upload the span between the first and last voiced frame
+        voiced_idx = np.flatnonzero(mask)
+        start, end = voiced_idx[0] * hop, min((voiced_idx[-1] + 1) * hop, len(y))
+        worth_trimming = 1 - (end - start) / len(y) >= MIN_TRIM_FRACTION
+        if worth_trimming:
+            transcript = await asyncio.to_thread(transcribe, mp3_path, y[start:end], sr)
+        else:
+            transcript = await asyncio.to_thread(transcribe, mp3_path)
+
     word_count = len(transcript.split())
     wpm = word_count / (duration / 60) if duration else 0
-    intervals = librosa.effects.split(y, top_db=30)
-    voiced = sum((e - s) for s, e in intervals) / sr
-    silence_ratio = (duration - voiced) / duration if duration else 0
     return {
         "duration": duration,
         "wpm": wpm,
@@ -201,44 +403,420 @@ def analyze_audio(mp3_path: str) -> Dict[str, Any]:
         "transcript": transcript
     }
 
+# ========== RATE LIMITING ==========
+class RateLimiter:
+    """Token buckets for requests and tokens per minute, plus an AIMD cap on in-flight calls."""
+
+    def __init__(self, rpm: int, tpm: int, max_inflight: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_inflight = max_inflight
+        self.inflight_limit = max_inflight
+        self.inflight = 0
+        self.successes = 0
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._last_refill = time.monotonic()
+        self._resume_at = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens: int):
+        """Block until one request of `tokens` tokens fits under every limit."""
+        if tokens > self.tpm:
+            logger.warning("event=request_exceeds_tpm tokens=%d tpm=%d", tokens, self.tpm)
+            tokens = self.tpm  # otherwise it could never start
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._resume_at:
+                    wait = self._resume_at - now
+                elif self.inflight >= self.inflight_limit:
+                    wait = None  # woken by release()
+                elif self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    self.inflight += 1
+                    return
+                else:
+                    wait = max((1 - self._requests) * 60 / self.rpm,
+                               (tokens - self._tokens) * 60 / self.tpm)
+                self._cond.wait(wait)
+
+    def release(self, ok: bool, rate_limited: bool = False, retry_after: float = 0.0):
+        """Free an in-flight slot: additive increase on success, halve the cap on a 429."""
+        with self._cond:
+            self.inflight -= 1
+            if ok:
+                self.successes += 1
+                if self.successes % AIMD_INCREASE_EVERY == 0 and self.inflight_limit < self.max_inflight:
+                    self.inflight_limit += 1
+            elif rate_limited:
+                self.successes = 0
+                self.inflight_limit = max(1, self.inflight_limit // 2)
+                self._resume_at = max(self._resume_at, time.monotonic() + retry_after)
+            self._cond.notify_all()
+
+
+class CircuitBreaker:
+    """Opens after fail_max consecutive transient failures; once reset_timeout passes, one probe is let through."""
+
+    def __init__(self, fail_max: int, reset_timeout: float, model: str = ""):
+        self.fail_max = fail_max
+        self.model = model
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Return True if this call may go to the primary model."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("event=breaker_closed model=%s failures=%d", self.model, self.failures)
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self, transient: bool = True):
+        """Count a failed primary call; any failed probe re-opens the breaker."""
+        with self._lock:
+            if self._probing:
+                self._probing = False
+                self.opened_at = time.monotonic()
+                logger.warning("event=breaker_reopened model=%s reset_timeout=%.0fs", self.model, self.reset_timeout)
+            elif transient and self.opened_at is None:
+                self.failures += 1
+                if self.failures >= self.fail_max:
+                    self.opened_at = time.monotonic()
+                    logger.warning("event=breaker_opened model=%s failures=%d fallback_model=%s",
+                                   self.model, self.failures, FALLBACK_MODEL)
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def _limiter_for(model: str) -> RateLimiter:
+    """OpenAI rate-limits each model separately, so each model gets its own limiter."""
+    with _rate_limiters_lock:
+        if model not in _rate_limiters:
+            tpm = int(TPM_LIMIT) if TPM_LIMIT else MODEL_TPM_LIMITS.get(model, DEFAULT_TPM_LIMIT)
+            _rate_limiters[model] = RateLimiter(RPM_LIMIT, tpm, MAX_INFLIGHT)
+        return _rate_limiters[model]
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def _breaker_for(model: str) -> CircuitBreaker:
+    """One breaker per primary model, so failures on one model never reroute calls for another."""
+    with _breakers_lock:
+        if model not in _breakers:
+            _breakers[model] = CircuitBreaker(BREAKER_FAIL_MAX, BREAKER_RESET_TIMEOUT, model)
+        return _breakers[model]
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str):
+    """Return the model's tiktoken encoding, or None if it cannot be loaded (first use downloads it)."""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except (OSError, ValueError) as e:  # requests' ConnectionError is an OSError
+        logger.warning("event=tokenizer_unavailable model=%s error=%s; estimating %d chars per token",
+                       model, type(e).__name__, CHARS_PER_TOKEN)
+        return None
+
+
+def count_text_tokens(text: str, model: str = GRADING_MODEL) -> int:
+    enc = _encoding(model)
+    if enc is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(enc.encode(text))
+
+
+# System prompts and exam prefixes repeat on every call, so their counts are memoized
+_count_fixed_tokens = functools.lru_cache(maxsize=64)(count_text_tokens)
+
+
+def count_message_tokens(messages: List[Dict[str, str]], model: str = GRADING_MODEL) -> int:
+    """Prompt tokens for a chat request, including the per-message framing overhead."""
+    return sum(4 + count_text_tokens(m.get("content") or "", model) for m in messages) + 3
+
+
+def check_prompt_fits(prompt_tokens: int, model: str, max_tokens: int) -> None:
+    """Raise ValueError if a prompt of `prompt_tokens` leaves no room for max_tokens."""
+    limit = MODEL_CONTEXT_TOKENS.get(model)
+    if limit is not None and prompt_tokens + max_tokens > limit:
+        raise ValueError(
+            f"Prompt is {prompt_tokens} tokens; {model} allows {limit - max_tokens} "
+            f"with {max_tokens} reserved for the completion"
+        )
+
+
+def estimate_request_tokens(kwargs: Dict[str, Any], prompt_tokens: int = None) -> int:
+    """Token cost of a chat request as counted against TPM: prompt plus completion budget."""
+    if prompt_tokens is None:
+        prompt_tokens = count_message_tokens(kwargs.get("messages", []), kwargs.get("model", GRADING_MODEL))
+    return prompt_tokens + kwargs.get("max_tokens", DEFAULT_COMPLETION_TOKENS)
+
+
+def retry_after_seconds(error: RateLimitError) -> float:
+    """Return the server's Retry-After hint in seconds, or 0 if absent."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return 0.0
+    try:
+        if "retry-after-ms" in response.headers:
+            return float(response.headers["retry-after-ms"]) / 1000
+        return float(response.headers.get("retry-after", 0))
+    except ValueError:
+        return 0.0
+
 # ========== GRADERS ==========
-def call_with_backoff(**kwargs):
+def call_with_backoff(prompt_tokens: int = None, **kwargs):
+    """Call the chat API with retries; pass `prompt_tokens` if already counted to skip re-tokenizing."""
     backoff = INITIAL_BACKOFF
+    tokens = estimate_request_tokens(kwargs, prompt_tokens)
+    primary_model = kwargs["model"]
+    breaker = _breaker_for(primary_model)
     for attempt in range(1, MAX_RETRIES + 1):
+        use_primary = breaker.allow()
+        model = primary_model if use_primary else FALLBACK_MODEL
+        resp, error, wait = None, None, 0.0
+        limiter = _limiter_for(model)
+        limiter.acquire(tokens)
         try:
-            return openai.chat.completions.create(**kwargs)
-        except (RateLimitError, OpenAIError, APIConnectionError, Timeout):
-            if attempt == MAX_RETRIES:
-                raise
-            time.sleep(backoff * (2 ** (attempt - 1)))
+            resp = _get_client().chat.completions.create(**{**kwargs, "model": model})
+        except OpenAIError as e:
+            error = e
+            if isinstance(e, RateLimitError):
+                wait = retry_after_seconds(e)
+        except BaseException:
+            if use_primary:
+                breaker.record_failure(transient=False)  # never leave a half-open probe pending
+            raise
+        finally:
+            # Free the in-flight slot whatever the call did
+            limiter.release(ok=resp is not None, rate_limited=isinstance(error, RateLimitError),
+                            retry_after=wait)
+
+        if error is None:
+            if use_primary:
+                breaker.record_success()
+            else:
+                logger.info("event=fallback_used model=%s primary_model=%s", model, primary_model)
+            return resp
+
+        if use_primary:
+            # APIConnectionError also covers APITimeoutError
+            breaker.record_failure(
+                transient=isinstance(error, (RateLimitError, APIConnectionError, InternalServerError))
+            )
+        if isinstance(error, RateLimitError):
+            logger.warning("event=call_failed error=rate_limit model=%s attempt=%d retry_after=%.1f",
+                           model, attempt, wait)
+        else:
+            logger.warning("event=call_failed error=%s model=%s attempt=%d", type(error).__name__, model, attempt)
+        if attempt == MAX_RETRIES:
+            raise error
+        time.sleep(wait or random.uniform(0, backoff * (2 ** (attempt - 1))))
+
+# System messages are fixed, so build each one once and reuse it for every call
+_SYSTEM_PROMPTS = {
+    "technical": "You are a helpful technical exam grader.",
+    "narrative": NARRATIVE_PROMPT_WITH_RUBRIC,
+    "narrative_no_rubric": NARRATIVE_PROMPT_NO_RUBRIC,
+}
+_SYSTEM_MSGS = {
+    (kind, batch): {"role": "system", "content": prompt + (BATCH_PROMPT_SUFFIX if batch else "")}
+    for kind, prompt in _SYSTEM_PROMPTS.items()
+    for batch in (False, True)
+}
 
-def grade_exam(rubric: str, questions: str, responses: str, exam_type: str = "narrative") -> dict:
-    rubric_markdown = rubric.strip() or "No rubric provided."
 
+@functools.lru_cache(maxsize=32)
+def _exam_prompt_prefix(rubric: str, questions: str, exam_type: str = "narrative") -> Tuple[str, str]:
+    """Return the system prompt kind and the user prompt up to the student responses."""
     if exam_type == "technical":
-        user_prompt = TECHNICAL_PROMPT_TEMPLATE.format(rubric_markdown=rubric_markdown) + f"\n\nQuestions:\n{questions}\n\nStudent Responses:\n{responses}"
-        system_prompt = "You are a helpful technical exam grader."
+        # str.replace, not str.format: the template's JSON example is full of literal braces
+        rubric_markdown = rubric.strip() or "No rubric provided."
+        prefix = TECHNICAL_PROMPT_TEMPLATE.replace("{rubric_markdown}", rubric_markdown) + f"\n\nQuestions:\n{questions}"
+        kind = "technical"
 
     else:  # narrative default
         if rubric.strip():
-            system_prompt = NARRATIVE_PROMPT_WITH_RUBRIC
-            user_prompt = f"Rubric:\n{rubric}\n\nQuestions:\n{questions}\n\nStudent Responses:\n{responses}"
+            kind = "narrative"
+            prefix = f"Rubric:\n{rubric}\n\nQuestions:\n{questions}"
         else:
-            system_prompt = NARRATIVE_PROMPT_NO_RUBRIC
-            user_prompt = f"Questions:\n{questions}\n\nStudent Responses:\n{responses}"
+            kind = "narrative_no_rubric"
+            prefix = f"Questions:\n{questions}"
+
+    return kind, prefix + "\n\nStudent Responses:\n"
+
+
+def build_grading_messages(rubric: str, questions: str, responses: str,
+                           exam_type: str = "narrative", batch: bool = False) -> List[Dict[str, str]]:
+    """Return the chat messages for grading `responses` against the exam."""
+    kind, prefix = _exam_prompt_prefix(rubric, questions, exam_type)
+    return [_SYSTEM_MSGS[kind, batch], {"role": "user", "content": prefix + responses}]
+
+
+def grading_prompt_tokens(rubric: str, questions: str, responses: str,
+                          exam_type: str = "narrative", batch: bool = False) -> int:
+    """Prompt tokens of build_grading_messages(); only the student responses are tokenized per call."""
+    kind, prefix = _exam_prompt_prefix(rubric, questions, exam_type)
+    fixed = _count_fixed_tokens(_SYSTEM_MSGS[kind, batch]["content"], GRADING_MODEL) + _count_fixed_tokens(prefix, GRADING_MODEL)
+    return fixed + count_text_tokens(responses, GRADING_MODEL) + 2 * 4 + 3
+
+
+def _result_key(exam_type: str, batch: bool = False):
+    return ("technical" if exam_type == "technical" else "narrative", batch)
 
+
+def grade_exam(rubric: str, questions: str, responses: str, exam_type: str = "narrative") -> dict:
+    return _grade_one(rubric, questions, responses, exam_type)[0]
+
+
+def _grade_one(rubric: str, questions: str, responses: str, exam_type: str = "narrative") -> Tuple[dict, str]:
+    """Grade one student; also return the model that served the request."""
+    messages = build_grading_messages(rubric, questions, responses, exam_type)
+    prompt_tokens = grading_prompt_tokens(rubric, questions, responses, exam_type)
+    check_prompt_fits(prompt_tokens, GRADING_MODEL, GRADING_MAX_TOKENS)
+
+    key = _result_key(exam_type)
     resp = call_with_backoff(
-        model="gpt-4-0613",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ],
+        prompt_tokens=prompt_tokens,
+        model=GRADING_MODEL,
+        messages=messages,
+        response_format=_RESPONSE_FORMATS[key],
+        max_tokens=GRADING_MAX_TOKENS,
         temperature=0,
         seed=42
     )
 
-    raw_response = resp.choices[0].message.content
+    choice = resp.choices[0]
+    message = choice.message
+    if message.refusal:
+        return {"error": "Refused", "raw": message.refusal}, resp.model
+    if choice.finish_reason == "length":
+        return {"error": "Truncated response", "raw": message.content}, resp.model
+    if choice.finish_reason != "stop":
+        return {"error": f"Incomplete response ({choice.finish_reason})", "raw": message.content}, resp.model
+    try:
+        return _RESULT_MODELS[key].model_validate_json(message.content).model_dump(), resp.model
+    except ValidationError:
+        return {"error": "Invalid JSON", "raw": message.content}, resp.model
+
+
+def grading_key(rubric: str, questions: str, responses: str, exam_type: str = "narrative") -> str:
+    """Content key for one grading: same model, prompts, rubric, questions, answers and exam type."""
+    hashes = [hashlib.sha256(part.encode("utf-8")).hexdigest() for part in (rubric, questions, responses)]
+    return hashlib.sha256("||".join([GRADING_MODEL, PROMPT_VERSION, exam_type, *hashes]).encode("utf-8")).hexdigest()
+
+
+def grade_exams_batch(rubric: str, questions: str, responses: Dict[str, str], exam_type: str = "narrative") -> Dict[str, dict]:
+    """
+    Grade several students in one request, so the rubric and instructions are sent once.
+    `responses` maps student id to that student's answers; the result uses the same keys.
+    Identical answers (blank, "did not attempt", copied) are graded once and the result is
+    shared; results are persisted in RUBRIC_CACHE_DIR so re-runs skip the API entirely
+    (except those served by FALLBACK_MODEL, which are re-graded next time).
+    """
+    keys = {sid: grading_key(rubric, questions, text, exam_type) for sid, text in responses.items()}
+
+    graded = {}
+    pending = {}  # key -> the one student id whose answers are sent for it
+    for sid, key in keys.items():
+        if key in graded or key in pending:
+            continue
+        try:
+            with open(os.path.join(RUBRIC_CACHE_DIR, key + ".grade.json"), "r", encoding="utf-8") as f:
+                graded[key] = json.load(f)
+        except (OSError, ValueError):  # missing or unreadable: grade it again
+            pending[key] = sid
+
+    def save(sid: str, result: dict, served_model: str):
+        # Persist as soon as each sub-request returns, so a later failure loses nothing already paid for
+        graded[keys[sid]] = result
+        if "error" not in result and served_model.startswith(GRADING_MODEL):
+            _write_cache_file(os.path.join(RUBRIC_CACHE_DIR, keys[sid] + ".grade.json"),
+                              json.dumps(result, ensure_ascii=False))
+
+    _grade_batch_request(rubric, questions, {sid: responses[sid] for sid in pending.values()}, exam_type, save)
+    return {sid: copy.deepcopy(graded[key]) for sid, key in keys.items()}
+
+
+def _grade_batch_request(rubric: str, questions: str, responses: Dict[str, str], exam_type: str,
+                         on_graded: Callable[[str, dict, str], None]):
+    """
+    Grade `responses` in one request, calling on_graded(student id, result, model that served it)
+    for each student as soon as its result is in. Batches too long for the model's context or
+    output limit are split in half; students missing from the batched reply are re-graded one by one.
+    """
+    if len(responses) <= 1:
+        for sid, text in responses.items():
+            on_graded(sid, *_grade_one(rubric, questions, text, exam_type))
+        return
+
+    responses_md = "\n\n".join(f"## Student {sid}\n{text}" for sid, text in responses.items())
+    messages = build_grading_messages(rubric, questions, responses_md, exam_type, batch=True)
+    max_tokens = PER_STUDENT_MAX_TOKENS * len(responses)
     try:
-        return json.loads(raw_response)
-    except json.JSONDecodeError:
-        return {"error": "Invalid JSON", "raw": raw_response}
+        if max_tokens > MODEL_MAX_OUTPUT_TOKENS.get(GRADING_MODEL, max_tokens):
+            raise ValueError(f"{GRADING_MODEL} cannot return {max_tokens} completion tokens")
+        prompt_tokens = grading_prompt_tokens(rubric, questions, responses_md, exam_type, batch=True)
+        check_prompt_fits(prompt_tokens, GRADING_MODEL, max_tokens)
+    except ValueError:
+        items = list(responses.items())
+        half = len(items) // 2
+        _grade_batch_request(rubric, questions, dict(items[:half]), exam_type, on_graded)
+        _grade_batch_request(rubric, questions, dict(items[half:]), exam_type, on_graded)
+        return
+
+    key = _result_key(exam_type, batch=True)
+    resp = call_with_backoff(
+        prompt_tokens=prompt_tokens,
+        model=GRADING_MODEL,
+        messages=messages,
+        response_format=_RESPONSE_FORMATS[key],
+        max_tokens=max_tokens,
+        temperature=0,
+        seed=42
+    )
+
+    choice = resp.choices[0]
+    message = choice.message
+    graded = {}
+    # A refused, incomplete (length, content_filter) or malformed batch falls through to per-student grading below
+    if not message.refusal and choice.finish_reason == "stop":
+        try:
+            batch = _RESULT_MODELS[key].model_validate_json(message.content)
+            graded = {student.student_id: student.grading.model_dump() for student in batch.students}
+        except ValidationError:
+            logger.warning("event=batch_invalid students=%d", len(responses))
+
+    for sid in responses:
+        if str(sid) in graded:
+            on_graded(sid, graded[str(sid)], resp.model)
+    for sid, text in responses.items():
+        if str(sid) not in graded:
+            on_graded(sid, *_grade_one(rubric, questions, text, exam_type))
@@ -0,0 +1,84 @@
+import unittest
+from unittest import mock
+
+import httpx
+from openai import APIConnectionError, InternalServerError
+
+import exam_grader_agents_multi_1 as graders
+
+REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def server_error():
+    return InternalServerError("server error", response=httpx.Response(500, request=REQUEST), body=None)
+
+
+class CallWithBackoffTest(unittest.TestCase):
+    def setUp(self):
+        # Fresh limiter/breaker per test; stub out the client, sleeping and tokenization
+        self.limiter = graders.RateLimiter(graders.RPM_LIMIT, graders.DEFAULT_TPM_LIMIT, graders.MAX_INFLIGHT)
+        self.breaker = graders.CircuitBreaker(graders.BREAKER_FAIL_MAX, graders.BREAKER_RESET_TIMEOUT)
+        self.create = mock.Mock()
+        client = mock.Mock()
+        client.chat.completions.create = self.create
+        for patcher in (
+            mock.patch.object(graders, "_limiter_for", return_value=self.limiter),
+            mock.patch.dict(graders._breakers, {"gpt-4o-2024-08-06": self.breaker}, clear=True),
+            mock.patch.object(graders, "_get_client", return_value=client),
+            mock.patch.object(graders.time, "sleep"),
+            mock.patch.object(graders, "count_message_tokens", return_value=5),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def call(self, model="gpt-4o-2024-08-06"):
+        return graders.call_with_backoff(
+            model=model,
+            messages=[{"role": "user", "content": "hi"}],
+            max_tokens=10
+        )
+
+    def test_connection_error_is_retried_and_releases_slots(self):
+        self.create.side_effect = [APIConnectionError(request=REQUEST), "ok"]
+        self.assertEqual(self.call(), "ok")
+        self.assertEqual(self.create.call_count, 2)
+        self.assertEqual(self.limiter.inflight, 0)
+
+    def test_server_errors_open_breaker_and_route_to_fallback(self):
+        self.create.side_effect = server_error()
+        for _ in range(2):  # MAX_RETRIES attempts each, at least BREAKER_FAIL_MAX in total
+            with self.assertRaises(InternalServerError):
+                self.call()
+        self.assertIsNotNone(self.breaker.opened_at)
+        self.assertEqual(self.limiter.inflight, 0)
+
+        self.create.side_effect = None
+        self.create.return_value = "ok"
+        self.assertEqual(self.call(), "ok")
+        self.assertEqual(self.create.call_args.kwargs["model"], graders.FALLBACK_MODEL)
+
+    def test_open_breaker_does_not_reroute_other_models(self):
+        self.breaker.opened_at = graders.time.monotonic()
+        self.create.return_value = "ok"
+        self.assertEqual(self.call(model="gpt-4-0613"), "ok")
+        self.assertEqual(self.create.call_args.kwargs["model"], "gpt-4-0613")
+
+    def test_counted_prompt_is_not_tokenized_again(self):
+        self.create.return_value = "ok"
+        with mock.patch.object(graders, "count_message_tokens") as count:
+            graders.call_with_backoff(prompt_tokens=5, model="gpt-4o-2024-08-06",
+                                      messages=[{"role": "user", "content": "hi"}], max_tokens=10)
+        count.assert_not_called()
+        self.assertNotIn("prompt_tokens", self.create.call_args.kwargs)
+
+    def test_unexpected_error_on_probe_reopens_breaker(self):
+        self.breaker.opened_at = 0.0  # opened long ago, so the next call is a probe
+        self.create.side_effect = ValueError("boom")
+        with self.assertRaises(ValueError):
+            self.call()
+        self.assertFalse(self.breaker._probing)
+        self.assertEqual(self.limiter.inflight, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,13 @@
 import os
 from pathlib import Path
 import time
+import asyncio
+import threading
 import json
 import statistics
 import pickle
+import hashlib
+import copy
 
 from dotenv import load_dotenv
 import openai
@@ -23,6 +27,10 @@ openai.api_key = os.getenv("OPENAI_API_KEY")
 MAX_RETRIES = 3
 INITIAL_BACKOFF = 2.0  # seconds
 METRICS_HISTORY_FILE = "grading_metrics_history.pkl"
+MAX_CONCURRENCY = 8  # concurrent grading requests in grade_exams_batch
+
+# Serializes read-modify-write of the metrics history across grading threads
+_HISTORY_LOCK = threading.Lock()
 
 # Define the function schema for structured output
 def get_functions():
@@ -119,18 +127,19 @@ def grade_exam(rubric: str, questions: str, responses: str) -> dict:
     scores = [q["score"] for q in output.get("scores", []) if isinstance(q.get("score"), (int, float))]
     elapsed = time.time() - start_time
 
-    # Load past scores
-    if os.path.exists(METRICS_HISTORY_FILE):
-        with open(METRICS_HISTORY_FILE, "rb") as f:
-            history = pickle.load(f)
-    else:
-        history = []
+    with _HISTORY_LOCK:
+        # Load past scores
+        if os.path.exists(METRICS_HISTORY_FILE):
+            with open(METRICS_HISTORY_FILE, "rb") as f:
+                history = pickle.load(f)
+        else:
+            history = []
 
-    history.append(scores)
+        history.append(scores)
 
-    # Save updated history
-    with open(METRICS_HISTORY_FILE, "wb") as f:
-        pickle.dump(history, f)
+        # Save updated history
+        with open(METRICS_HISTORY_FILE, "wb") as f:
+            pickle.dump(history, f)
 
     # Flatten all scores for MAE and RMSE
     all_scores = [score for run in history for score in run]
@@ -153,6 +162,35 @@ def grade_exam(rubric: str, questions: str, responses: str) -> dict:
 
     return output
 
+# Content key for one grading: identical rubric, questions and responses share it
+def grading_key(rubric: str, questions: str, responses: str) -> str:
+    hashes = [hashlib.sha256(part.encode("utf-8")).hexdigest() for part in (rubric, questions, responses)]
+    return hashlib.sha256("||".join(hashes).encode("utf-8")).hexdigest()
+
+# Grade several exams concurrently via OpenAI
+async def grade_exams_batch(input_data_list: list, max_concurrency: int = MAX_CONCURRENCY) -> list:
+    """
+    Grade a batch of (rubric, questions, responses) tuples concurrently.
+    At most max_concurrency requests are in flight; results keep input order.
+    Identical inputs (e.g. blank or copied answers) share a single grading call.
+    """
+    sem = asyncio.Semaphore(max_concurrency)
+    shared = {}  # grading key -> task graded once for every identical input
+
+    async def _one(input_data):
+        async with sem:
+            return await asyncio.to_thread(grade_exam, *input_data)
+
+    def _dispatch(input_data):
+        key = grading_key(*input_data)
+        if key not in shared:
+            shared[key] = asyncio.ensure_future(_one(input_data))
+        return shared[key]
+
+    results = await asyncio.gather(*[_dispatch(x) for x in input_data_list])
+    # Duplicates share one result object; hand each caller its own copy
+    return [copy.deepcopy(r) for r in results]
+
 # Create PDF report
 def create_pdf_report(results: dict, output_path: Path):
     c = canvas.Canvas(str(output_path), pagesize=letter)
@@ -0,0 +1,41 @@
+import os
+import json
+import asyncio
+from pathlib import Path
+from dotenv import load_dotenv
+
+from exam_grader_agents import extract_text, grade_exams_batch, create_pdf_report
+
+# 1) Load environment variables from .env
+load_dotenv()
+# Ensure the OPENAI_API_KEY environment variable is set
+assert os.getenv("OPENAI_API_KEY"), "Missing OPENAI_API_KEY in environment"
+
+# 2) Define file paths relative to this script
+BASE_DIR = Path(__file__).parent
+EXAM_OUTPUTS = BASE_DIR / "exam_outputs"
+STUDENT_OUTPUTS = BASE_DIR / "student_outputs"
+REPORTS_DIR = BASE_DIR / "graded_reports"
+
+RUBRIC_FILE = EXAM_OUTPUTS / "rubric.txt"
+
+# 3) Collect every student response, matched to its exam by filename (e.g. exam3_student2.pdf -> exam3.txt)
+rubric_text = extract_text(RUBRIC_FILE)
+response_files = sorted(STUDENT_OUTPUTS.glob("exam*_student*.pdf"))
+inputs = []
+for response_pdf in response_files:
+    exam_name = response_pdf.stem.split("_")[0]
+    questions_text = extract_text(EXAM_OUTPUTS / f"{exam_name}.txt")
+    inputs.append((rubric_text, questions_text, extract_text(response_pdf)))
+
+# 4) Grade all exams concurrently
+all_results = asyncio.run(grade_exams_batch(inputs))
+
+# 5) Output JSON to console and generate one PDF report per student
+REPORTS_DIR.mkdir(exist_ok=True)
+for response_pdf, results in zip(response_files, all_results):
+    print(f"=== {response_pdf.name} ===")
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    output_pdf = REPORTS_DIR / f"graded_report_{response_pdf.stem}.pdf"
+    create_pdf_report(results, output_pdf)
+    print(f"✓ Graded report saved to {output_pdf}")
@@ -1,25 +1,30 @@
+import re
+
 import pdfplumber
 
+# Leading/trailing whitespace of a line, and a bullet glyph run at the start of a line
+EDGE_SPACE_RE = re.compile(r"^[^\S\n]+|[^\S\n]+$", re.M)
+BULLET_RE = re.compile(r"^[*•·-]+[^\S\n]*", re.M)
+
 def extract_pdf_to_markdown(pdf_path):
-    markdown_output = ""
+    markdown_parts = []
 
     with pdfplumber.open(pdf_path) as pdf:
         for page_number, page in enumerate(pdf.pages, start=1):
             text = page.extract_text()
             tables = page.extract_tables()
 
-            markdown_output += f"\n\n## Page {page_number}\n"
+            markdown_parts.append(f"\n\n## Page {page_number}\n")
 
             # 1. Add extracted text (already respects bullets and numbers)
             if text:
-                cleaned_text = clean_text_formatting(text)
-                markdown_output += cleaned_text
+                markdown_parts.append(clean_text_formatting(text))
 
             # 2. Add extracted tables in markdown
             for table in tables:
-                markdown_output += "\n\n" + convert_table_to_markdown(table)
+                markdown_parts.append("\n\n" + convert_table_to_markdown(table))
 
-    return markdown_output.strip()
+    return "".join(markdown_parts).strip()
 
 def clean_text_formatting(text):
     """
@@ -27,22 +32,8 @@ def clean_text_formatting(text):
     - Standardizes bullet points
     - Ensures consistent line breaks
     """
-    lines = text.split("\n")
-    cleaned_lines = []
-    for line in lines:
-        stripped = line.strip()
-        if not stripped:
-            cleaned_lines.append("")  # Preserve blank lines
-            continue
-        # Convert bullet characters to markdown-style "-"
-        if stripped.startswith(("*", "•", "·", "-")):
-            cleaned_lines.append("- " + stripped.lstrip("*•·-").strip())
-        # Safely check for numbered lists like "1." or "2-"
-        elif len(stripped) > 2 and stripped[:2].isdigit() and stripped[2] in ".-":
-            cleaned_lines.append(stripped)
-        else:
-            cleaned_lines.append(stripped)
-    return "\n".join(cleaned_lines) + "\n"
+    # Strip each line, then convert bullet characters to markdown-style "-"
+    return BULLET_RE.sub("- ", EDGE_SPACE_RE.sub("", text)) + "\n"
 
 
 def convert_table_to_markdown(table):
@@ -53,14 +44,13 @@ def convert_table_to_markdown(table):
     rows = table[1:]
 
     # Build the header row
-    md_table = "| " + " | ".join(header) + " |\n"
-    md_table += "| " + " | ".join(["---"] * len(header)) + " |\n"
+    header_line = "| " + " | ".join(cell if cell else "" for cell in header) + " |"
+    sep_line = "| " + " | ".join(["---"] * len(header)) + " |"
 
     # Add data rows
-    for row in rows:
-        md_table += "| " + " | ".join(cell if cell else "" for cell in row) + " |\n"
+    rows_md = ["| " + " | ".join(cell if cell else "" for cell in row) + " |" for row in rows]
 
-    return md_table
+    return "\n".join([header_line, sep_line, *rows_md]) + "\n"
 
 # Example usage
 if __name__ == "__main__":
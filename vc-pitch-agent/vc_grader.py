@@ -2,8 +2,9 @@ import os
 import sys
 import json
 import openai
-import librosa
+import numpy as np
 import soundfile as sf
+from pydub import AudioSegment
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -72,17 +73,41 @@ def transcribe(mp3_path: str) -> str:
     return transcript
 
 # 2 – Compute audio metrics
+def load_audio(mp3_path: str):
+    """Decode audio to a mono float32 array at its native sample rate"""
+    try:
+        y, sr = sf.read(mp3_path, dtype="float32", always_2d=False)
+    except sf.SoundFileError:
+        # libsndfile builds without MP3 support: decode through pydub/ffmpeg
+        segment = AudioSegment.from_file(mp3_path)
+        y = np.array(segment.get_array_of_samples(), dtype=np.float32)
+        y /= float(1 << (8 * segment.sample_width - 1))
+        y = y.reshape(-1, segment.channels)
+        sr = segment.frame_rate
+    if y.ndim > 1:
+        y = y.mean(axis=1)
+    return y, sr
+
+def voiced_samples(y, sr: int, top_db: float = 30) -> int:
+    """Count voiced samples like librosa.effects.split: centred frames every 32 ms, 4 hops wide"""
+    hop = max(1, int(sr * 0.032))
+    frame_length = 4 * hop
+    frames = np.lib.stride_tricks.sliding_window_view(np.pad(y, frame_length // 2), frame_length)[::hop]
+    rms = np.sqrt(np.einsum("ij,ij->i", frames, frames) / frame_length)
+    if not len(y) or rms.max() == 0:
+        return 0
+    return min(int((rms > rms.max() * 10 ** (-top_db / 20)).sum()) * hop, len(y))
+
 def audio_metrics(mp3_path: str):
     """Return words-per-minute, silence ratio, transcript, duration"""
-    y, sr = librosa.load(mp3_path, sr=16000, mono=True)
+    y, sr = load_audio(mp3_path)
     duration = len(y) / sr
 
     transcript = transcribe(mp3_path)
     words = transcript.split()
     wpm = len(words) / (duration / 60) if duration else 0
 
-    segments = librosa.effects.split(y, top_db=30)
-    voiced = sum((end - start) for start, end in segments) / sr
+    voiced = voiced_samples(y, sr) / sr
     silence_ratio = (duration - voiced) / duration if duration else 0
 
     return wpm, silence_ratio, transcript, duration